@@ -6,14 +6,68 @@ M. Capotosto
 NSLS-II Diagnostics and Instrumentation
 """
 
-# pylint: disable=bare-except
 # pylint: disable=broad-except
 # pylint: disable=too-many-public-methods
 # pylint: disable=invalid-name
 
-from time import sleep
+from contextlib import contextmanager
+from time import sleep, monotonic
+import numpy as np
+from pyvisa import VisaIOError, constants
+from pyvisa.constants import EventMechanism, EventType
+from pyvisa.errors import InvalidBinaryFormat
 from .visa_utils import connect_usb_instrument, \
-    connect_ethernet_instrument  # Importing utility module
+    connect_ethernet_instrument, close_instrument  # Importing utility module
+
+TIMEOUT = 20000  # VISA Timeout in ms
+CHUNK_SIZE = 20 * 1024 * 1024  # Read a full CURVE? block in one call
+ESB = 32  # Event Status Bit of the status byte
+MAX_RETRIES = 5  # acquire_waveform attempts before giving up
+
+# Accepted setter arguments (short and long forms), checked before writing
+_BW_VALID = frozenset({"TWE", "TWENTY", "TWO", "TWOFIFTY", "FUL", "FULL"})
+_COUPLING_VALID = frozenset({"AC", "DC", "GND"})
+_TERM_VALID = frozenset({"FIF", "FIFTY", "MEG"})
+_UNITS_VALID = frozenset(unit.upper() for unit in (
+    "%", "/Hz", "A", "A/A", "A/V", "A/W", "A/dB", "A/s", "AA", "AW", "AdB",
+    "As", "B", "Hz", "IRE", "S/s", "V", "V/A", "V/V", "V/W", "V/dB", "V/s",
+    "VV", "VW", "VdB", "Volts", "Vs", "W", "W/A", "W/V", "W/W", "W/dB",
+    "W/s", "WA", "WV", "WW", "WdB", "Ws", "dB", "dB/A", "dB/V", "dB/W",
+    "dB/dB", "dBA", "dBV", "dBW", "dBdB", "day", "degrees", "div", "hr",
+    "min", "ohms", "percent", "s"))
+
+
+def _curve_datatype(width, enc):
+    """Return the (struct code, big endian) pair for a CURVE? block
+    with the given DATA:WIDTH and DATA:ENC settings.
+    Raises ValueError for encodings that are not integer binary (e.g.
+    ASCIi), which acquire_waveform cannot parse."""
+    enc = str(enc).upper()
+    if not enc.startswith(("RI", "RP", "SRI", "SRP")):
+        raise ValueError(f"Invalid binary encoding: {enc!r}")
+    code = "b" if int(width) == 1 else "h"
+    if enc.startswith(("RP", "SRP")):  # Unsigned encodings
+        code = code.upper()
+    return code, not enc.startswith("SR")  # SRI/SRP are byte swapped
+
+
+def _validate(name, value, valid, numeric=False):
+    """Raise ValueError unless value is in valid (case-insensitive) or,
+    when numeric is set, parses as an <NR3> number."""
+    if str(value).upper() in valid:
+        return
+    if numeric:
+        try:
+            float(value)
+            return
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid {name}: {value!r}")
+
+
+def _to_volts(data, ymult, yzero, yoff):
+    """Scale raw CURVE? samples to vertical units as float32"""
+    return (data.astype(np.float32) - yoff) * ymult + yzero
 
 
 class DPO4000:
@@ -21,7 +75,6 @@ class DPO4000:
     # *************************************************************************
     # ******Initialize Connection******
     def __init__(self, connection_method, address):
-        TIMEOUT = 20000  # VISA Timeout in ms
         if connection_method == "USB":
             self.device, self.address, self.status = \
                 connect_usb_instrument(address)
@@ -32,6 +85,30 @@ class DPO4000:
             self.connected_with = 'Ethernet' \
                 if self.status == "Connected" else None
         self.device.timeout = TIMEOUT
+        self.device.chunk_size = CHUNK_SIZE
+        # CURVE? blocks end in a single LF after the #N<len> payload, so
+        # binary reads can stop at the terminator instead of chunking
+        self.device.read_termination = "\n"
+        self.device.write_termination = "\n"
+        self.device.send_end = True
+        # Raise SRQ (via ESB) when *OPC sets the Operation Complete bit
+        self.device.write("*ESE 1;*SRE 32")
+        self._w = self.device.write  # Bound once for the hot setter paths
+        self._pending = {}  # Queued channel setter values keyed by header
+        self._deferred = False
+
+    def close(self):
+        """Release the VISA session; it is closed once no other driver
+        uses it"""
+        close_instrument(self.device)
+        self.device, self.status, self.connected_with = \
+            None, "Not Connected", None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     # *************************************************************************
     # ******Status Commands******
@@ -44,27 +121,101 @@ class DPO4000:
         command = "*WAI"
         self.device.write(command)
 
-    def wait_until_ready(self):
-        """Waits until the oscilloscope is ready for the next command."""
-        while True:
+    def wait_until_ready(self, timeout=TIMEOUT):
+        """Waits until the oscilloscope is ready for the next command.
+        Arms *OPC and waits for the resulting service request instead of
+        repeatedly querying *OPC?. Sessions without SRQ event support fall
+        back to polling the status byte.
+        The SRQ event is enabled before *OPC is armed, so a fast operation
+        cannot complete before the wait starts listening.
+        """
+        srq = (EventType.service_request, EventMechanism.queue)
+        try:
+            self.device.enable_event(*srq)
+        except (VisaIOError, NotImplementedError):
+            self.device.write("*CLS;*OPC")
+            self._poll_status_byte(timeout)
+        else:
             try:
-                if int(self.device.query("*OPC?")):  # Query if the operation \
-                    # is complete
-                    break
-            except Exception:
-                sleep(0.1)  # Small delay before retrying
+                self.device.write("*CLS;*OPC")
+                self.device.wait_on_event(EventType.service_request, timeout)
+            finally:
+                self.device.disable_event(*srq)
+                self.device.discard_events(*srq)
+        self.device.query("*ESR?")  # Clear the OPC event
+
+    def _poll_status_byte(self, timeout):
+        """Poll the status byte until ESB is set, backing off from 10ms
+        to 80ms between reads.
+        Reads are scheduled against monotonic() rather than sleeping a
+        fixed interval, so sleep() overshoot and the time spent in
+        read_stb() do not add up across iterations."""
+        start = monotonic()
+        deadline = start + timeout / 1000
+        next_poll = start
+        delay = 0.01
+        while not self.device.read_stb() & ESB:
+            now = monotonic()
+            if now > deadline:
+                raise VisaIOError(constants.StatusCode.error_timeout)
+            next_poll += delay
+            sleep(max(0.0, next_poll - now))
+            delay = min(delay * 2, 0.08)
+
+    # *************************************************************************
+    # ******Command Queue******
+    def _enqueue(self, header, value):
+        """Queue a "header value" setter, replacing any earlier value for
+        the same header. Written immediately unless inside batch()."""
+        self._pending.pop(header, None)
+        self._pending[header] = value
+        if not self._deferred:
+            self.flush()
+
+    def flush(self):
+        """Write all queued setter commands as one compound message"""
+        if self._pending:
+            command = ";:".join([f"{header} {value}" for header, value
+                                 in self._pending.items()])
+            self._pending.clear()
+            self._w(command)
+
+    @contextmanager
+    def batch(self):
+        """Defer channel setters until the block exits, then write them in
+        a single message. Repeated setters for the same channel attribute
+        only send the last value. Nested batch() blocks join the outermost
+        one, which does the flush.
+
+        with scope.batch():
+            scope.vertical_position("1", "1")
+            scope.chan_vertical_scale("1", "0.5")
+        """
+        if self._deferred:
+            yield self  # Nested; the outer block flushes
+            return
+        self._deferred = True
+        try:
+            yield self
+        except BaseException:
+            self._pending.clear()
+            raise
+        finally:
+            self._deferred = False
+        self.flush()
+
     # *************************************************************************
     # ******Horizontal Commands******
 
     def horizontal_record_length(self, hor_rec_length="10000"):
         """define a HORIZONTAL RECORD LENGTH function"""
         command = f"HOR:RECO {hor_rec_length}"
-        self.device.write(command)
+        self._w(command)
 
     def horizontal_scale(self, hor_scale_length="100e-9"):
         """define a HORIZONTAL SCALE LENGTH function"""
         command = f"HORIZONTAL:SCALE {hor_scale_length}"
-        self.device.write(command)
+        self._w(command)
 
     # *************************************************************************
     # ******VERTICAL Commands******
@@ -72,58 +223,52 @@ class DPO4000:
         """define a BANDWIDTH function
         VALUES: TWEnty | TWOfifty | FULl | <NR3>
         """
-        command = f"CH{chan}:BANDWIDTH {bandwidth}"
-        self.device.write(command)
+        _validate("bandwidth", bandwidth, _BW_VALID, numeric=True)
+        self._enqueue(f"CH{chan}:BANDWIDTH", bandwidth)
 
     def coupling(self, chan, coupling="DC"):
         """Define a COUPLING function
         VALUES: AC | DC | GND
         """
-        command = f"CH{chan}:COUPLING {coupling}"
-        self.device.write(command)
+        _validate("coupling", coupling, _COUPLING_VALID)
+        self._enqueue(f"CH{chan}:COUPLING", coupling)
 
     def deskew(self, chan, delay="0E+00"):
         """Define a DESKEW delay
         Arguments: Time -100ns to +100ns in E- notation
         """
-        command = f"CH{chan}:DESKEW {delay}"
-        self.device.write(command)
+        self._enqueue(f"CH{chan}:DESKEW", delay)
 
     def invert(self, chan, invert="off"):
         """Invert DISPLAY WAVEFORM"""
-        command = f"CH{chan}:INVert {invert}"
-        self.device.write(command)
+        self._enqueue(f"CH{chan}:INVert", invert)
 
     def label(self, chan, label=""):
         """Set Channel Label"""
-        command = f"CH{chan}:LABel {label}"
-        self.device.write(command)
+        self._enqueue(f"CH{chan}:LABel", label)
 
     def vertical_position(self, chan, pos=0):
         """Set Vertical Position
         VALUES: -8 to +8 divisions
         """
-        command = f"CH{chan}:POSition {pos}"
-        self.device.write(command)
+        self._enqueue(f"CH{chan}:POSition", pos)
 
     def probe_gain(self, chan, gain="1.0E+00"):
         """Set probe gain/attenuation"""
-        command = f"CH{chan}:PROBE:GAIN {gain}"
-        self.device.write(command)
+        self._enqueue(f"CH{chan}:PROBE:GAIN", gain)
 
     def chan_vertical_scale(self, chan, scale):
         """Set vertical scale
         Values in E-notation
         """
-        command = f"CH{chan}:SCALE {scale}"
-        self.device.write(command)
+        self._enqueue(f"CH{chan}:SCALE", scale)
 
     def chan_termination(self, chan, term="MEG"):
         """Sets channel termination
         Values: FIFty | MEG | <NR3>
         """
-        command = f"CH{chan}:TERMINATION {term}"
-        self.device.write(command)
+        _validate("termination", term, _TERM_VALID, numeric=True)
+        self._enqueue(f"CH{chan}:TERMINATION", term)
 
     def chan_units(self, chan, units="V"):
         """Sets channel units.
@@ -131,93 +276,82 @@ class DPO4000:
         IRE, S/s, V, V/A, V/V, V/W, V/dB, V/s, VV, VW, VdB, Volts, Vs, W, W/A,
         W/V, W/W, W/dB, W/s,WA, WV,WW, WdB, Ws, dB, dB/A, dB/V, dB/W, dB/dB,
         dBA, dBV, dBW, dBdB, day, degrees, div, hr, min, ohms, percent, s"""
-        command = f"CH{chan}:YUNITS {units}"
-        self.device.write(command)
+        _validate("units", units, _UNITS_VALID)
+        self._enqueue(f"CH{chan}:YUNITS", units)
 
     # *************************************************************************
     # ******Acquire Commands******
     def select_ch(self, chan):
         """Select Channel waveform on/off, select for acq"""
         command = f"SELECT:CH{chan}"
-        self.device.write(command)
+        self._w(command)
 
     def acquire_stopafter(self, stopafter_val="SEQUENCE"):
         """define a ACQUISITION STOP AFTER function"""
         command = f"ACQUIRE:STOPAFTER {stopafter_val}"
-        self.device.write(command)
+        self._w(command)
 
     def acquire_state(self, acq_state="1"):
         """define a ACQUISITION STATE function"""
         command = f"ACQUIRE:STATE {acq_state}"
-        self.device.write(command)
+        self._w(command)
 
     # *************************************************************************
     # ******DATA Commands******
     def data_source(self, chan):
         """define a DATA SOURCE function"""
         command = f"DATA:SOU CH{chan}"
-        self.device.write(command)
+        self._w(command)
 
     def data_width(self, width="1"):
         """define a DATA WIDTH function"""
         command = f"DATA:WIDTH {width}"
-        self.device.write(command)
+        self._w(command)
 
     def data_encoding(self, enc="RPB"):
         """define a DATA ENCODING function"""
         command = f"DATA:ENC {enc}"
-        self.device.write(command)
+        self._w(command)
+
+    def data_binary(self, width="2"):
+        """Select signed binary CURVE? transfer
+        Values: 1 | 2 bytes per sample
+        """
+        command = f"DATA:ENC RIBinary;:DATA:WIDTH {width}"
+        self._w(command)
 
     # *************************************************************************
     # ******WAVEFORM PREAMBLE Commands******
-    def wfmpre_ymult(self):
-        """Query the vertical scale factor (YMULT) from the
-        waveform preamble"""
-        command = "WFMPRE:YMULT?"
+    def _read_preamble(self):
+        """Query YMULT, YZERO, YOFF and XINCR in one compound query.
+        Returns them as a float64 array in that order."""
+        response = self.device.query("WFMPRE:YMULT?;YZERO?;YOFF?;XINCR?")
+        return np.fromstring(response, sep=";")
+
+    def _preamble_value(self, index, name):
+        """Return a single preamble value, or None on error"""
         try:
-            # self.wait_until_ready()
-            # print("wait until")
-            self.wai()
-            ymult = float(self.device.query(command))  # Send query and
-            # print("Passed ymult...")
-            # convert response to float
-            return ymult
+            return float(self._read_preamble()[index])
         except Exception as e:
-            print(f"Error querying YMULT: {e}")
+            print(f"Error querying {name}: {e}")
             return None
 
+    def wfmpre_ymult(self):
+        """Query the vertical scale factor (YMULT) from the
+        waveform preamble"""
+        return self._preamble_value(0, "YMULT")
+
     def wfmpre_yzero(self):
         """Query the vertical offset (YZERO) from the waveform preamble"""
-        command = "WFMPRE:YZERO?"
-        try:
-            yzero = float(self.device.query(command))  # Send query and
-            # convert response to float
-            return yzero
-        except Exception as e:
-            print(f"Error querying YZERO: {e}")
-            return None
+        return self._preamble_value(1, "YZERO")
 
     def wfmpre_yoff(self):
         """Query the vertical offset (YOFF) from the waveform preamble"""
-        command = "WFMPRE:YOFF?"
-        try:
-            yoff = float(self.device.query(command))  # Send query and convert
-            # response to float
-            return yoff
-        except Exception as e:
-            print(f"Error querying YOFF: {e}")
-            return None
+        return self._preamble_value(2, "YOFF")
 
     def wfmpre_xincr(self):
         """Query the horizontal increment (XINCR) from the waveform preamble"""
-        command = "WFMPRE:XINCR?"
-        try:
-            xincr = float(self.device.query(command))  # Send query and
-            # convert response to float
-            return xincr
-        except Exception as e:
-            print(f"Error querying XINCR: {e}")
-            return None
+        return self._preamble_value(3, "XINCR")
 
 # *************************************************************************
 # ******DATA COLLECTION FUNCTIONS******
@@ -225,40 +359,83 @@ class DPO4000:
     def config_acq(self, stopafter_val, acq_state):
 
         """Configure scope acquisition"""
-        self.acquire_stopafter(stopafter_val)
-        self.acquire_state(acq_state)
-        self.wai()
-
-    def acquire_waveform(self, chan, width="1", enc="RPB"):
-        """Acquire the waveform"""
-        good = 0
-        while good == 0:
+        command = (f"ACQUIRE:STOPAFTER {stopafter_val};"
+                   f":ACQUIRE:STATE {acq_state};*WAI")
+        self._w(command)
+
+    def acquire_waveform(self, chan, width="2", enc="RIBinary"):
+        """Acquire the waveform as a binary block.
+        Returns the samples scaled to vertical units as a float32 numpy
+        array, and the sample interval XINCR in seconds.
+        """
+        datatype, big_endian = _curve_datatype(width, enc)
+        for attempt in range(MAX_RETRIES):
             try:
-                self.data_source(chan)
-                self.data_width(width)
-                self.data_encoding(enc)
-                ymult = float(self.wfmpre_ymult())
-                yzero = self.wfmpre_yzero()
-                yoff = self.wfmpre_yoff()
-                xincr = self.wfmpre_xincr()
-                self.device.write("CURVE?")
-                data = self.device.read_raw()
-                good = 1
-            except:  # noqa: E722
-                good = 0
-        return ymult, yzero, yoff, xincr, data
+                # One compound write/query each instead of 3 writes and
+                # 4 preamble queries, saving a round trip per command.
+                command = (f"DATA:SOU CH{chan};:DATA:WIDTH {width};"
+                           f":DATA:ENC {enc}")
+                self._w(command)
+                # Python floats keep the scaling below in float32
+                ymult, yzero, yoff, xincr = self._read_preamble().tolist()
+                data = self.device.query_binary_values(
+                    "CURVE?", datatype=datatype, is_big_endian=big_endian,
+                    container=np.ndarray)
+                break
+            except (VisaIOError, InvalidBinaryFormat, ValueError) as e:
+                # InvalidBinaryFormat covers a malformed block header and
+                # ValueError a malformed preamble
+                print(f"Error acquiring CH{chan} "
+                      f"(attempt {attempt + 1}/{MAX_RETRIES}): {e}")
+                # Discard any unread CURVE? bytes so the next attempt's
+                # preamble query does not read them
+                try:
+                    self.device.clear()
+                except VisaIOError as clear_error:
+                    print(f"Error clearing device: {clear_error}")
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                sleep(0.05 * 2 ** attempt)
+        return _to_volts(data, ymult, yzero, yoff), xincr
+
+    def acquire_all_channels(self, chans=("1", "2", "3", "4"), width="2",
+                             enc="RIBinary"):
+        """Acquire several channels in one pass.
+        Width and encoding are set once and every channel's preamble is
+        read in a single compound query, followed by one CURVE? per
+        channel. Returns a dict of chan: (volts, xincr).
+        """
+        datatype, big_endian = _curve_datatype(width, enc)
+        command = f"DATA:WIDTH {width};:DATA:ENC {enc}"
+        self._w(command)
+        query = ";:".join([f"DATA:SOU CH{chan};"
+                           ":WFMPRE:YMULT?;YZERO?;YOFF?;XINCR?"
+                           for chan in chans])
+        preambles = np.fromstring(self.device.query(query), sep=";")
+        waveforms = {}
+        for chan, (ymult, yzero, yoff, xincr) in zip(
+                chans, preambles.reshape(len(chans), 4).tolist()):
+            command = f"DATA:SOU CH{chan}"
+            self._w(command)
+            data = self.device.query_binary_values(
+                "CURVE?", datatype=datatype, is_big_endian=big_endian,
+                container=np.ndarray)
+            waveforms[chan] = (_to_volts(data, ymult, yzero, yoff), xincr)
+        return waveforms
 
     def scope_test(self):
         """Scope test"""
-        self.vertical_position("1", "1")
-        self.vertical_position("2", "2")
-        self.vertical_position("3", "3")
-        sleep(1)
-        self.vertical_position("1", "-1")
-        self.vertical_position("2", "-2")
-        self.vertical_position("3", "-3")
-        self.vertical_position("4", "-5")
-        sleep(1)
+        with self.batch():
+            self.vertical_position("1", "1")
+            self.vertical_position("2", "2")
+            self.vertical_position("3", "3")
+        self.wait_until_ready()
+        with self.batch():
+            self.vertical_position("1", "-1")
+            self.vertical_position("2", "-2")
+            self.vertical_position("3", "-3")
+            self.vertical_position("4", "-5")
+        self.wait_until_ready()
 
     def measure_amplitude(self, chan, meastype):
         """Select Channel waveform on/off, select for acq"""
@@ -276,4 +453,4 @@ if __name__ == "__main__":
         scope = DPO4000("IP", "10.0.142.3")
         scope.scope_test()
         scope.reset()
-        i += i
+        i += 1
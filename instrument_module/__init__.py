@@ -21,6 +21,7 @@ Package Contents:
 - DG4000: Driver for Rigol DG4000 Series Function Generators.
 - DP800: Driver for Rigol DP800 Series Power Supplies.
 - DPO4000: Driver for Tektronix DPO4000/MSO4000 Series Oscilloscopes.
+- DG4000Proxy, DP800Proxy: The same drivers run in a worker process.
 - visa_utils: Helper functions for VISA connection and resource listing.
 """
 
@@ -29,15 +30,42 @@ Package Contents:
 
 # Expose main classes directly for cleaner imports
 # (e.g., from instrument_suite import DP800)
+# Driver modules are imported on first attribute access (PEP 562), so a
+# script that only uses one driver does not import the others.
 
-from .keithley_2100 import Keithley2100
-from .keithley_6221 import Keithley6221
-from .rigol_dg4000 import DG4000
-from .rigol_dp800 import DP800
-from .Tek_DPO4000 import DPO4000
+import importlib
+
+_LAZY_CLASSES = {
+    "Keithley2100": ".keithley_2100",
+    "Keithley6221": ".keithley_6221",
+    "DG4000": ".rigol_dg4000",
+    "DP800": ".rigol_dp800",
+    "DPO4000": ".Tek_DPO4000",
+    "DG4000Proxy": ".visa_proc",
+    "DP800Proxy": ".visa_proc",
+}
 
 # Also expose the utility functions/module
-from . import visa_utils
+_LAZY_MODULES = {"visa_utils": ".visa_utils"}
+
+
+def __getattr__(name):
+    """Import a driver class or utility module on first access."""
+    if name in _LAZY_CLASSES:
+        module = importlib.import_module(_LAZY_CLASSES[name], __name__)
+        value = getattr(module, name)
+    elif name in _LAZY_MODULES:
+        value = importlib.import_module(_LAZY_MODULES[name], __name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value  # Cache so __getattr__ is skipped next time
+    return value
+
+
+def __dir__():
+    """Include the lazily imported names in dir()."""
+    return sorted(set(globals()) | set(__all__))
+
 
 # --- RECOMMENDED ADDITION: Package Version ---
 __version__ = "1.0.0"
@@ -48,6 +76,8 @@ __all__ = [
     "DG4000",
     "DP800",
     "DPO4000",
+    "DG4000Proxy",
+    "DP800Proxy",
     "visa_utils",
     "__version__"
 ]
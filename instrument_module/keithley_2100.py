@@ -7,10 +7,13 @@ M. Capotosto
 NSLS-II Diagnostics and Instrumentation
 """
 
-from time import sleep
-from .visa_utils import connect_usb_instrument
+import numpy as np
+from .visa_utils import connect_usb_instrument, temporary_timeout, \
+    close_instrument
 
 DELAY = 0.01  # 10ms delay
+RESET_TIMEOUT = 10000  # Upper bound on *RST completion in ms
+MAX_NPLC = 100  # Longest integration time, in power line cycles
 
 
 class Keithley2100:
@@ -24,13 +27,26 @@ class Keithley2100:
                 connect_usb_instrument(address)
             self.connected_with = 'USB' if self.status == "Connected" else None
 
+    def close(self):
+        """Release the VISA session; it is closed once no other driver
+        uses it"""
+        close_instrument(self.device)
+        self.device, self.status, self.connected_with = \
+            None, "Not Connected", None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     # *************************************************************************
     # ******Factory Reset******
     def factory_reset(self):
         """define a FACTORY RESET function"""
-        command = "*RST"
-        self.device.write(command)
-        sleep(5)  # 5 second delay to wait for reset to finish...
+        command = "*RST;*OPC?"
+        with temporary_timeout(self.device, RESET_TIMEOUT):
+            self.device.query(command)  # Returns once the reset is done
 
     # *************************************************************************
     # MEASure COMMAND SET
@@ -46,6 +62,32 @@ class Keithley2100:
             print(f"Error querying MEASURE:VOLTAGE:DC {e}")
             return None
 
+    def read_dcv_block(self, n, nplc=1, meas_range="100"):
+        """Take n DC voltage readings in one buffered burst
+        Faster than calling meas_dcv n times, which reconfigures and
+        triggers the DMM for every point. Returns a numpy array.
+        """
+        command = f"CONF:VOLT:DC {meas_range};:SAMP:COUN {n};" \
+            f":VOLT:DC:NPLC {nplc}"
+        try:
+            plc = float(nplc)
+        except ValueError:
+            plc = MAX_NPLC  # MIN/MAX/DEF: assume the longest integration
+        # Allow ~2x the total integration time at 50 Hz on top of the
+        # normal timeout
+        timeout = self.device.timeout + int(n * plc * 40)
+        try:
+            self.device.write(command)
+            with temporary_timeout(self.device, timeout):
+                # The 2100 has no binary FORMat, so the buffer comes back
+                # as one comma separated ASCII response
+                return self.device.query_ascii_values(
+                    "READ?", container=np.ndarray)
+
+        except Exception as e:
+            print(f"Error querying READ? {e}")
+            return None
+
     def meas_res(self, meas_range="100", resolution="DEF"):
         """Measure resistance"""
         command = f"MEASURE:RESISTANCE? {meas_range},{resolution}"
@@ -60,10 +102,8 @@ class Keithley2100:
     def dmm_test(self):
         """DMM Test"""
         vout = self.meas_dcv(100)
-        sleep(1)
         print(f"DC Volts Measured: {vout}")
         res = self.meas_res()
-        sleep(1)
         print(f"Measured resistance out: {res}")
 
 
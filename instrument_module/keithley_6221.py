@@ -6,10 +6,11 @@ M. Capotosto
 NSLS-II Diagnostics and Instrumentation
 """
 
-from time import sleep
-from .visa_utils import connect_ethernet_instrument
+from .visa_utils import connect_ethernet_instrument, temporary_timeout, \
+    close_instrument
 
 DELAY = 0.01  # 10ms delay
+RESET_TIMEOUT = 10000  # Upper bound on *RST completion in ms
 
 
 class Keithley6221:
@@ -17,30 +18,51 @@ class Keithley6221:
     # *************************************************************************
     # ******Initialize Connection******
     def __init__(self, connection_method, address):
+        self._idn_cache = None  # *IDN? is fixed for the session
         if connection_method == "IP":
             self.device, self.address, self.status = \
                 connect_ethernet_instrument(address)
             self.connected_with = 'Ethernet' \
                 if self.status == "Connected" else None
 
+    def close(self):
+        """Release the VISA session; it is closed once no other driver
+        uses it"""
+        close_instrument(self.device)
+        self.device, self.status, self.connected_with = \
+            None, "Not Connected", None
+        self._idn_cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     def idn(self):
         """Query the IDN"""
         idn_response = self.device.write("*IDN?")
         return idn_response
 
     def get_idn(self):
-        """Measure resistance"""
-        command = "*IDN?"
-        idn = self.device.query(command)
-        return idn
+        """Query the IDN, reusing the first response"""
+        if self._idn_cache is None:
+            command = "*IDN?"
+            self._idn_cache = self.device.query(command)
+        return self._idn_cache
 
     # *************************************************************************
     # ******Factory Reset******
     def factory_reset(self):
         """define a FACTORY RESET function"""
-        command = "*RST"
-        self.device.write(command)
-        sleep(5)  # 5 second delay to wait for reset to finish...
+        command = "*RST;*OPC?"
+        with temporary_timeout(self.device, RESET_TIMEOUT):
+            self.device.query(command)  # Returns once the reset is done
+        self._idn_cache = None
+
+    def wait_opc(self):
+        """Block until all pending operations have completed"""
+        return self.device.query("*OPC?")
 
     # ************************************************************************
     # Global Commands
@@ -49,16 +71,17 @@ class Keithley6221:
         command = "CLEar"
         self.device.write(command)
 
-    def output(self, output="OFF"):
+    def output(self, output="OFF", sync=False):
         """Turn the output ON or OFF"""
         command = f"OUTPut {output}"
         self.device.write(command)
-        sleep(1)
+        if sync:
+            self.wait_opc()
 
     # *************************************************************************
     # DC Current Output Command Set
 
-    def irange(self, irange="0.1"):
+    def irange(self, irange="0.1", sync=False):
         """Set output current range. Use only if not using AUto-Ranging!
         Setting manual range will disable auto ranging
 
@@ -71,22 +94,26 @@ class Keithley6221:
         """
         command = f"CURRent:RANGe {irange}"
         self.device.write(command)
-        sleep(1)
+        if sync:
+            self.wait_opc()
 
-    def auto_range(self, autorange="OFF"):
+    def auto_range(self, autorange="OFF", sync=False):
         """Enable or disable autorange, ON or OFF"""
         command = f"CURRent:RANGe:AUTO {autorange}"
         self.device.write(command)
-        sleep(1)
+        if sync:
+            self.wait_opc()
 
-    def current(self, current):
+    def current(self, current, sync=False):
         """Set DC current source output level (amps, -105mA to 105mA)"""
         command = f"CURRent {current}"
         self.device.write(command)
-        sleep(1)
+        if sync:
+            self.wait_opc()
 
-    def compliance(self, compliance="0"):
+    def compliance(self, compliance="0", sync=False):
         """Set compliance voltage, 100mV to 105V"""
         command = f"CURRent:COMPliance {compliance}"
         self.device.write(command)
-        sleep(1)
+        if sync:
+            self.wait_opc()
@@ -7,11 +7,14 @@ M. Capotosto
 NSLS-II Diagnostics and Instrumentation
 """
 
-from time import sleep
+import numpy as np
 # Import the existing connection utilities directly
-from .visa_utils import connect_usb_instrument, connect_ethernet_instrument
+from .visa_utils import connect_usb_instrument, connect_ethernet_instrument, \
+    temporary_timeout, close_instrument
 
 DELAY = 0.01  # 10ms delay
+RESET_TIMEOUT = 10000  # Upper bound on *RST completion in ms
+MAX_NPLC = 100  # Longest integration time, in power line cycles
 
 
 class Keysight34461A:
@@ -54,13 +57,26 @@ class Keysight34461A:
             if self.device:
                 self.device.timeout = 5000
 
+    def close(self):
+        """Release the VISA session; it is closed once no other driver
+        uses it"""
+        close_instrument(self.device)
+        self.device, self.status, self.connected_with = \
+            None, "Not Connected", None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     # *************************************************************************
     # ******Factory Reset******
     def factory_reset(self):
         """Define a FACTORY RESET function (*RST)"""
-        command = "*RST"
-        self.device.write(command)
-        sleep(5)  # 5 second delay to wait for reset to finish...
+        command = "*RST;*OPC?"
+        with temporary_timeout(self.device, RESET_TIMEOUT):
+            self.device.query(command)  # Returns once the reset is done
 
     # *************************************************************************
     # MEASure COMMAND SET - MIMICKING KEITHLEY DMM COMMANDS
@@ -86,6 +102,47 @@ class Keysight34461A:
             print(f"Error querying MEASURE:VOLTAGE:DC: {e}")
             return None
 
+    def read_dcv_block(self, n, nplc=1, meas_range="AUTO"):
+        """
+        Take n DC voltage readings in one buffered burst. (Much faster than
+        calling meas_dcv n times, which reconfigures and triggers per point)
+
+        Parameters:
+            n (int): Number of readings to take (SAMPle:COUNt).
+            nplc (float/str): Integration time in power line cycles, or
+                              MIN, MAX or DEF.
+            meas_range (str/float): The voltage range (e.g., '10', 'AUTO').
+        Returns:
+            numpy.ndarray: The n readings in volts, or None if an error
+                           occurs.
+        """
+        command = f"CONF:VOLT:DC {meas_range};:SAMP:COUN {n};" \
+            f":SENS:VOLT:DC:NPLC {nplc};:FORM:DATA REAL,64"
+        try:
+            plc = float(nplc)
+        except ValueError:
+            plc = MAX_NPLC  # MIN/MAX/DEF: assume the longest integration
+        # Allow ~2x the total integration time at 50 Hz on top of the
+        # normal timeout
+        timeout = self.device.timeout + int(n * plc * 40)
+        try:
+            self.device.write(command)
+            with temporary_timeout(self.device, timeout):
+                readings = self.device.query_binary_values(
+                    "READ?", datatype="d", is_big_endian=True,
+                    container=np.ndarray)
+
+        except Exception as e:
+            print(f"Error querying READ?: {e}")
+            readings = None
+        finally:
+            try:
+                # meas_* expect ASCII responses
+                self.device.write("FORM:DATA ASC")
+            except Exception as e:
+                print(f"Error restoring FORM:DATA ASC: {e}")
+        return readings
+
     def meas_res(self, meas_range="AUTO", resolution="DEF"):
         """
         Measure resistance. (Mimics Keithley2100 meas_res)
@@ -120,13 +177,11 @@ class Keysight34461A:
 
         # Test DC Voltage measurement
         vout = self.meas_dcv(meas_range="10")
-        sleep(1)
         if vout is not None:
             print(f"DC Volts Measured (10V range, Auto Resolution): {vout} V")
 
         # Test Resistance measurement
         res = self.meas_res(meas_range="AUTO")
-        sleep(1)
         if res is not None:
             print(f"Measured Resistance (Auto range, Auto Resolution): "
                   f"{res} Ohms")
@@ -5,11 +5,14 @@ M. Capotosto
 3/4/2025
 NSLS-II Diagnostics and Instrumentation
 """
+from contextlib import contextmanager
 from time import sleep
 from .visa_utils import connect_usb_instrument, \
-    connect_ethernet_instrument  # Importing utility module
+    connect_ethernet_instrument, write_sync, run_in_thread, \
+    temporary_timeout, close_instrument, \
+    session_state  # Importing utility module
 
-DELAY = 0.01  # 10ms delay
+RESET_TIMEOUT = 10000  # Upper bound on *RST completion in ms
 
 
 class DG4000:
@@ -17,6 +20,7 @@ class DG4000:
     # *************************************************************************
     # ******Initialize Connection******
     def __init__(self, connection_method, address):
+        self._batch = None  # Buffered commands while inside batch()
         if connection_method == "USB":
             self.device, self.address, self.status = \
                 connect_usb_instrument(address)
@@ -26,6 +30,59 @@ class DG4000:
                 connect_ethernet_instrument(address)
             self.connected_with = 'Ethernet' \
                 if self.status == "Connected" else None
+        else:
+            raise ValueError(
+                f"Unknown connection_method {connection_method!r}")
+        if self.status != "Connected":
+            raise ConnectionError(
+                f"Could not connect to {address} over {connection_method}")
+        self._session = session_state(self.device)  # Shared per session
+        self._lock = self._session["lock"]  # Serializes the *_async calls
+
+    def close(self):
+        """Release the VISA session; it is closed once no other driver
+        uses it"""
+        close_instrument(self.device)
+        self.device, self.status, self.connected_with = \
+            None, "Not Connected", None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, command):
+        """Write command, or buffer it while inside batch()"""
+        if self._batch is not None:
+            self._batch.append(command)
+        else:
+            self.device.write(command)
+
+    @contextmanager
+    def batch(self):
+        """Buffer setter commands until the block exits, then send them as
+        one compound message followed by a single *OPC? wait. Queries
+        inside the block are not buffered and run immediately. Nested
+        batch() blocks join the outermost one, which does the flush.
+
+        with sg.batch():
+            sg.source_fixed_freq("1", "1000")
+            sg.source_voltage_level("1", "2")
+            sg.output_state("1", "ON")
+        """
+        if self._batch is not None:
+            yield self  # Nested; the outer block flushes
+            return
+        self._batch = []
+        try:
+            yield self
+        except BaseException:
+            self._batch = None
+            raise
+        commands, self._batch = self._batch, None
+        if commands:
+            write_sync(self.device, ";".join(commands))
 
     def idn(self):
         """Query the IDN"""
@@ -42,9 +99,9 @@ class DG4000:
     # ******Factory Reset******
     def factory_reset(self):
         """define a FACTORY RESET function"""
-        command = "*RST"
-        self.device.write(command)
-        sleep(5)  # 5 second delay to wait for reset to finish...
+        command = "*RST;*OPC?"
+        with temporary_timeout(self.device, RESET_TIMEOUT):
+            self.device.query(command)  # Returns once the reset is done
 
     # *************************************************************************
     # Output Configuration
@@ -58,56 +115,49 @@ class DG4000:
         MAXimum
         """
         command = f":OUTP{chan}:IMP {impedance}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def noise_state(self, chan, noise_state_val):
         """Define a NOISE STATE function
         BOOL ON or OFF
         """
         command = f":OUTP{chan}:NOIS:STAT {noise_state_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def noise_scale(self, chan, noise_scale_val):
         """Define a NOISE SCALE function
         Range 0% to 50%
         """
         command = f":OUTP{chan}:NOIS:SCAL {noise_scale_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def output_polarity(self, chan, output_polarity_val):
         """Define an OUTPUT POLARITY function
         Values: NORMal|INVerted
         """
         command = f":OUTP{chan}:POL {output_polarity_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def output_state(self, chan, output_state_val):
         """Define an OUTPUT STATE function
         Values: ON|OFF
         """
         command = f":OUTP{chan}:STAT {output_state_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def sync_polarity(self, chan, sync_polarity_val):
         """Define a SYNC POLARITY function
         Values: POSitive|NEGative
         """
         command = f":OUTP{chan}:SYNC:POL {sync_polarity_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def sync_state(self, chan, sync_state_val):
         """Define a SYNC STATE function
         Values: ON|OFF
         """
         command = f":OUTP{chan}:SYNC:STAT {sync_state_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     # *************************************************************************
     # ******Source Frequency Configuration******
@@ -120,48 +170,41 @@ class DG4000:
     def source_center_freq(self, chan, source_center_freq_val):
         """Define a SOURCE CENTER FREQ function"""
         command = f":SOUR{chan}:FREQ:CENT {source_center_freq_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def source_fixed_freq(self, chan, source_fixed_freq_val):
         """Define a SOURCE FIXED FREQ function"""
         command = f":SOUR{chan}:FREQ:FIX {source_fixed_freq_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def source_span_freq(self, chan, source_span_freq_val):
         """Define a SOURCE SPAN FREQ function"""
         command = f":SOUR{chan}:FREQ:SPAN {source_span_freq_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def source_start_freq(self, chan, source_start_freq_val):
         """Define a SOURCE START FREQ function"""
         command = f":SOUR{chan}:FREQ:STAR {source_start_freq_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def source_stop_freq(self, chan, source_stop_freq_val):
         """Define a SOURCE STOP FREQ function"""
         command = f":SOUR{chan}:FREQ:STOP {source_stop_freq_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     # *************************************************************************
     # ******Source Function Configuration******
     def source_function_arb_step(self, chan, source_function_arb_step_val):
         """Define a SOURCE FUNCTION ARB STEP function"""
         command = f":SOUR{chan}:FUNC:ARB:STEP {source_function_arb_step_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def source_function_ramp_symmetry(self, chan,
                                       source_function_ramp_symmetry_val):
         """Define a SOURCE FUNCTION RAMP SYMMETRY function"""
-        command = f":SOUR{chan}:FUNC:RAMP:SYMM \
-            {source_function_ramp_symmetry_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        command = (f":SOUR{chan}:FUNC:RAMP:SYMM "
+                   f"{source_function_ramp_symmetry_val}")
+        self._write(command)
 
     def source_function_shape_wave(self, chan, source_function_shape_wave_val):
         """Define a SOURCE FUNCTION SHAPE WAVE function
@@ -186,28 +229,34 @@ class DG4000:
         """
 
         command = f":SOUR{chan}:FUNC:SHAP {source_function_shape_wave_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
+
+    def upload_waveform(self, chan, samples):
+        """Upload an arbitrary waveform to volatile memory
+        Values: DAC codes, integers 0 to 16383
+        Sent as one IEEE 488.2 binary block instead of a long ASCII list.
+        Not buffered by batch().
+        """
+        self.device.write_binary_values(f":SOUR{chan}:DATA:DAC VOLATILE,",
+                                        samples, datatype="H",
+                                        is_big_endian=False)
 
     def source_function_square_dcycle(self, chan,
                                       source_function_square_dcycle_val):
         """Define a SOURCE FUNCTION SQUARE DUTY CYCLE function
         Value: 0 to 100% real numbers only
         """
-        command = f":SOUR{chan}:FUNC:SQU:DCYC \
-            {source_function_square_dcycle_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        command = (f":SOUR{chan}:FUNC:SQU:DCYC "
+                   f"{source_function_square_dcycle_val}")
+        self._write(command)
 
     def source_function_pulse_dcycle(self, chan,
                                      source_function_pulse_dcycle_val):
         """Define a SOURCE FUNCTION PULSE DUTY CYCLE function
         Value: 0 to 100% real numbers only
         """
-        command = f":SOUR{chan}:PULSe:DCYC" \
-            f"{source_function_pulse_dcycle_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        command = f":SOUR{chan}:PULS:DCYC {source_function_pulse_dcycle_val}"
+        self._write(command)
 
     # *************************************************************************
     # ******Source Voltage Configuration******
@@ -217,8 +266,7 @@ class DG4000:
         Default VPP
         """
         command = f":SOUR{chan}:VOLT:LEV:IMM:AMPL {source_voltage_level_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def source_voltage_high(self, chan, source_voltage_high_val):
         """Define a SOURCE VOLTAGE HIGH LEVEL function
@@ -226,8 +274,7 @@ class DG4000:
         Range up to 10V HighZ or 5V into 50R
         """
         command = f":SOUR{chan}:VOLT:LEV:IMM:HIGH {source_voltage_high_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def source_voltage_low(self, chan, source_voltage_low_val):
         """Define a SOURCE VOLTAGE LOW LEVEL function
@@ -235,38 +282,82 @@ class DG4000:
         Range up to -10V HighZ or -5V into 50R
         """
         command = f":SOUR{chan}:VOLT:LEV:IMM:LOW {source_voltage_low_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def source_voltage_offset(self, chan, source_voltage_offset_val):
         """Define a SOURCE VOLTAGE OFFSET LEVEL function
         Unit: Volts
         """
-        command = f"SOURce{chan}:VOLT:OFFS: {source_voltage_offset_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        command = f":SOUR{chan}:VOLT:OFFS {source_voltage_offset_val}"
+        self._write(command)
 
     def source_voltage_unit(self, chan, source_voltage_unit_val):
         """Define a SOURCE VOLTAGE UNIT function
         Values: VPP|VRMS|DBM
         """
         command = f":SOURCE{chan}:VOLT:UNIT {source_voltage_unit_val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
+
+    # *************************************************************************
+    # ******Async Variants******
+    # Run the blocking call in a worker thread, so several instruments can
+    # be driven at once with asyncio.gather
+
+    async def call_async(self, method, *args, **kwargs):
+        """Awaitable form of any driver method, e.g.
+        await fg.call_async(fg.source_function_shape, "1", "SQU")"""
+        return await run_in_thread(self._lock, method, *args, **kwargs)
+
+    async def output_state_async(self, chan, output_state_val):
+        """Awaitable OUTPUT STATE function"""
+        return await self.call_async(self.output_state, chan,
+                                     output_state_val)
+
+    async def source_fixed_freq_async(self, chan, source_fixed_freq_val):
+        """Awaitable SOURCE FIXED FREQ function"""
+        return await self.call_async(self.source_fixed_freq, chan,
+                                     source_fixed_freq_val)
+
+    async def source_voltage_level_async(self, chan,
+                                         source_voltage_level_val):
+        """Awaitable SOURCE VOLTAGE LEVEL function"""
+        return await self.call_async(self.source_voltage_level, chan,
+                                     source_voltage_level_val)
 
     def gen_test(self):
         """Function Gen test"""
         self.source_voltage_unit("1", "VPP")
-        self.source_voltage_level("1", "1")
+        self.apply_sine("1", "1000", "1", "0", "0")
         sleep(1)
-        self.source_voltage_level("1", "10")
+        self.apply_sine("1", "1000", "10", "0", "0")
         sleep(1)
 
+    # *************************************************************************
+    # ******Apply******
+    # :APPLy sets shape, frequency, amplitude, offset and phase/delay in one
+    # command; prefer these over chaining the individual SOURCE setters.
+
+    def _apply(self, chan, shape, *params):
+        """Write :SOUR<chan>:APPL:<shape> with comma separated params"""
+        values = ",".join(str(p) for p in params)
+        command = f":SOUR{chan}:APPL:{shape} {values}"
+        self._write(command)
+
+    def apply_sine(self, chan, freq, amp, offset, phase):
+        """Function Gen apply sine"""
+        self._apply(chan, "SIN", freq, amp, offset, phase)
+
+    def apply_square(self, chan, freq, amp, offset, phase):
+        """Function Gen apply square"""
+        self._apply(chan, "SQU", freq, amp, offset, phase)
+
+    def apply_ramp(self, chan, freq, amp, offset, phase):
+        """Function Gen apply ramp"""
+        self._apply(chan, "RAMP", freq, amp, offset, phase)
+
     def apply_pulse(self, chan, freq, amp,   offset, delay_l):
         """Function Gen apply pulse"""
-        command = f":SOURce{chan}:APPLy:PULSe {freq}, {amp}, {offset}, " \
-            f"{delay_l}"
-        self.device.write(command)
+        self._apply(chan, "PULS", freq, amp, offset, delay_l)
 
 
 if __name__ == "__main__":
@@ -13,12 +13,17 @@ M. Capotosto
 NSLS-II Diagnostics and Instrumentation
 """
 
+from contextlib import contextmanager
 from time import sleep
+import numpy as np
 from .visa_utils import connect_usb_instrument, \
-    connect_ethernet_instrument  # Importing utility module
+    connect_ethernet_instrument, write_sync, run_in_thread, \
+    temporary_timeout, close_instrument, \
+    session_state  # Importing utility module
 
 
 DELAY = 0.01  # 10ms delay
+RESET_TIMEOUT = 10000  # Upper bound on *RST completion in ms
 
 
 class DP800:
@@ -26,6 +31,8 @@ class DP800:
     # *************************************************************************
     # ******Initialize Connection******
     def __init__(self, connection_method, address):
+        self._batch = None  # Buffered commands while inside batch()
+        self._batch_chan = None  # Channel the buffered commands leave set
         if connection_method == "USB":
             self.device, self.address, self.status = \
                 connect_usb_instrument(address)
@@ -35,114 +42,218 @@ class DP800:
                 connect_ethernet_instrument(address)
             self.connected_with = 'Ethernet' \
                 if self.status == "Connected" else None
+        else:
+            raise ValueError(
+                f"Unknown connection_method {connection_method!r}")
+        if self.status != "Connected":
+            raise ConnectionError(
+                f"Could not connect to {address} over {connection_method}")
+        self._session = session_state(self.device)  # Shared per session
+        self._lock = self._session["lock"]  # Serializes the *_async calls
+
+    def close(self):
+        """Release the VISA session; it is closed once no other driver
+        uses it"""
+        close_instrument(self.device)
+        self.device, self.status, self.connected_with = \
+            None, "Not Connected", None
+
+    @property
+    def _active_chan(self):
+        """Last channel sent with :INST:NSEL on this session, or None.
+        Inside batch() this is the channel the buffered commands select,
+        which is only shared with the session once they have been sent."""
+        if self._batch is not None:
+            return self._batch_chan
+        return self._session.get("active_chan")
+
+    @_active_chan.setter
+    def _active_chan(self, chan):
+        if self._batch is not None:
+            self._batch_chan = chan
+        else:
+            self._session["active_chan"] = chan
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, command):
+        """Write command, or buffer it while inside batch()"""
+        if self._batch is not None:
+            self._batch.append(command)
+        else:
+            self.device.write(command)
+
+    def _write_sync(self, command):
+        """write_sync command, or buffer it while inside batch(), where the
+        single *OPC? on exit covers it"""
+        if self._batch is not None:
+            self._batch.append(command)
+        else:
+            write_sync(self.device, command)
+
+    @contextmanager
+    def batch(self):
+        """Buffer setter commands until the block exits, then send them as
+        one compound message followed by a single *OPC? wait. Queries
+        inside the block are not buffered and run immediately. Nested
+        batch() blocks join the outermost one, which does the flush.
+
+        with psu.batch():
+            psu.set_voltage(2, 5)
+            psu.set_current(2, 0.5)
+            psu.toggle_output(2, "ON")
+        """
+        if self._batch is not None:
+            yield self  # Nested; the outer block flushes
+            return
+        # The first buffered command for a channel always selects it, as
+        # another driver may move the selection before the flush
+        self._batch, self._batch_chan = [], None
+        try:
+            yield self
+        except BaseException:
+            self._batch = None  # Nothing was sent
+            raise
+        commands, self._batch = self._batch, None
+        if commands:
+            self._active_chan = None  # Unknown until the write succeeds
+            write_sync(self.device, ";".join(commands))
+            self._active_chan = self._batch_chan
 
     # *************************************************************************
     # ******Factory Reset******
     def factory_reset(self):
         """define a FACTORY RESET function"""
-        command = "*RST"
-        self.device.write(command)
-        sleep(5)  # 5 second delay to wait for reset to finish...
+        command = "*RST;*OPC?"
+        with temporary_timeout(self.device, RESET_TIMEOUT):
+            self.device.query(command)  # Returns once the reset is done
+        self._active_chan = None
 
     # *************************************************************************
     # Output Configuration
 
+    def _write_chan(self, chan, command):
+        """write_sync command for chan, prefixed with :INST:NSEL unless chan
+        is already selected. The selection is only recorded once the write
+        succeeds, so a failed write forces a fresh :INST:NSEL next time.
+        Selections made on the front panel are not tracked; call
+        select_output() to resynchronize."""
+        chan = str(chan)
+        if chan != self._active_chan:
+            command = f":INST:NSEL {chan};{command}"
+        self._active_chan = None  # Unknown until the write succeeds
+        self._write_sync(command)
+        self._active_chan = chan
+
     def select_output(self, chan):
         """define a CHANNEL SELECT function"""
         command = f":INST:NSEL {chan}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._active_chan = None  # Unknown until the write succeeds
+        self._write_sync(command)
+        self._active_chan = str(chan)
 
     def toggle_output(self, chan, state):
         """Define a TOGGLE OUTPUT function"""
         command = f":OUTP CH{chan},{state}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write(command)
 
     def set_voltage(self, chan, val):
         """define a SET VOLTAGE function"""
-        command = f":INST:NSEL {chan}"
-        self.device.write(command)
-        sleep(DELAY)
         command = f":VOLT {val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write_chan(chan, command)
 
     def set_current(self, chan, val):
         """define a SET CURRENT function"""
-        command = f":INST:NSEL {chan}"
-        self.device.write(command)
-        sleep(DELAY)
         command = f":CURR {val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write_chan(chan, command)
 
     def set_ovp(self, chan, val):
         """define a SET VOLT PROTECTION function"""
-        command = f":INST:NSEL {chan}"
-        self.device.write(command)
-        sleep(DELAY)
         command = f":VOLT:PROT {val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write_chan(chan, command)
 
     def toggle_ovp(self, chan, state):
         """define a TOGGLE VOLTAGE PROTECTION function"""
-        command = f":INST:NSEL {chan}"
-        self.device.write(command)
-        sleep(DELAY)
-        command = f"VOLT:PROT:STAT {state}"
-        self.device.write(command)
-        sleep(DELAY)
+        command = f":VOLT:PROT:STAT {state}"
+        self._write_chan(chan, command)
 
     def set_ocp(self, chan, val):
         """define a SET CURRENT PROTECTION function"""
-        command = f":INST:NSEL {chan}"
-        self.device.write(command)
-        sleep(DELAY)
         command = f":CURR:PROT {val}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write_chan(chan, command)
 
     def toggle_ocp(self, chan, state):
         """define a TOGGLE CURRENT PROTECTION function"""
-        command = f":INST:NSEL {chan}"
-        self.device.write(command)
-        sleep(DELAY)
         command = f":CURR:PROT:STAT {state}"
-        self.device.write(command)
-        sleep(DELAY)
+        self._write_chan(chan, command)
 
     def measure_voltage(self, chan):
         """define a MEASURE VOLTAGE function"""
         command = f":MEAS:VOLT? CH{chan}"
-        volt = self.device.query(command)
-        volt = float(volt)
-        sleep(DELAY)
+        volt = self.device.query_ascii_values(command, container=list)[0]
         return volt
 
     def measure_current(self, chan):
         """define a MEASURE CURRENT function"""
         command = f":MEAS:CURR? CH{chan}"
-        curr = self.device.query(command)
-        curr = float(curr)
-        sleep(DELAY)
+        curr = self.device.query_ascii_values(command, container=list)[0]
         return curr
 
     def measure_power(self, chan):
         """define a MEASURE POWER function"""
         command = f":MEAS:POWE? CH{chan}"
-        power = self.device.query(command)
-        power = float(power)
-        sleep(DELAY)
+        power = self.device.query_ascii_values(command, container=list)[0]
         return power
 
+    def measure_all(self, chan):
+        """define a MEASURE ALL function
+        Returns [voltage, current, power] as a numpy array from one
+        :MEAS:ALL? query, in place of separate measure_voltage/current/power
+        round trips.
+        """
+        command = f":MEAS:ALL? CH{chan}"
+        return self.device.query_ascii_values(command, container=np.ndarray)
+
     def apply(self, chan, voltage, current):
         """Apply command function for simple voltage/current setting"""
-        command = f":APP CH{chan},{voltage},{current}"
-        power = self.device.query(command)
-        power = float(power)
-        sleep(DELAY)
+        # :APPL has no response to read
+        command = f":APPL CH{chan},{voltage},{current}"
+        self._write(command)
+        self._active_chan = None  # :APPL may move the channel selection
+
+    # *************************************************************************
+    # Async Variants
+    # Run the blocking call in a worker thread, so several instruments can
+    # be driven at once, e.g.:
+    #   await asyncio.gather(psu_a.set_voltage_async(1, 5.0),
+    #                        psu_b.set_voltage_async(1, 5.0))
+    # Any other method can be awaited through call_async, e.g.
+    #   await psu.call_async(psu.set_ovp, 1, 6.0)
+
+    async def call_async(self, method, *args, **kwargs):
+        """Awaitable form of any driver method (a bound method of this
+        instance), run under the session lock"""
+        return await run_in_thread(self._lock, method, *args, **kwargs)
+
+    async def set_voltage_async(self, chan, val):
+        """Awaitable SET VOLTAGE function"""
+        return await self.call_async(self.set_voltage, chan, val)
+
+    async def set_current_async(self, chan, val):
+        """Awaitable SET CURRENT function"""
+        return await self.call_async(self.set_current, chan, val)
+
+    async def toggle_output_async(self, chan, state):
+        """Awaitable TOGGLE OUTPUT function"""
+        return await self.call_async(self.toggle_output, chan, state)
+
+    async def measure_voltage_async(self, chan):
+        """Awaitable MEASURE VOLTAGE function"""
+        return await self.call_async(self.measure_voltage, chan)
 
     def psu_test(self):
         """PSU Test"""
@@ -156,29 +267,28 @@ class DP800:
 
 if __name__ == "__main__":
     psu = DP800("IP", "10.0.142.1")
+    # The loop only sends constant settings, so build each compound
+    # command once and write the raw bytes (write_raw adds no terminator).
+    # These bypass the driver's channel selection tracking.
+    SETUP_CH2 = b":INST:NSEL 2;:VOLT 15;:CURR 0.5\n"
+    SETUP_CH3 = b":INST:NSEL 3;:VOLT 15;:CURR 0.5\n"
+    OUTPUTS_ON = b":OUTP CH2,ON;:OUTP CH3,ON\n"
+    STEP_1 = (b":INST:NSEL 1;:VOLT 1;:INST:NSEL 2;:VOLT 2;"
+              b":INST:NSEL 3;:VOLT 3\n")
+    STEP_2 = (b":INST:NSEL 1;:VOLT 2;:INST:NSEL 2;:VOLT 3;"
+              b":INST:NSEL 3;:VOLT 4\n")
+    write_raw = psu.device.write_raw
     while 1:
-        psu.set_voltage(chan="2", val="15")
-        sleep(0.2)
-        psu.set_current(chan="2", val="0.5")
-        sleep(0.2)
-        psu.set_voltage(chan="3", val="15")
-        sleep(0.2)
-        psu.set_current(chan="3", val="0.5")
-        sleep(0.2)
-        psu.toggle_output("2", "ON")
-        sleep(0.2)
-        psu.toggle_output("3", "ON")
+        write_raw(SETUP_CH2)
+        write_raw(SETUP_CH3)
+        write_raw(OUTPUTS_ON)
         sleep(0.2)
-        CHAN2 = int(psu.measure_voltage("2"))
-        print(CHAN2)
-        CHAN3 = int(psu.measure_voltage("3"))
-        print(CHAN3)
+        CHAN2_V, CHAN2_I, CHAN2_P = psu.measure_all("2")
+        print(f"CH2: {CHAN2_V} V, {CHAN2_I} A, {CHAN2_P} W")
+        CHAN3_V, CHAN3_I, CHAN3_P = psu.measure_all("3")
+        print(f"CH3: {CHAN3_V} V, {CHAN3_I} A, {CHAN3_P} W")
         # continue
-        psu.set_voltage("1", "1")
-        psu.set_voltage("2", "2")
-        psu.set_voltage("3", "3")
+        write_raw(STEP_1)
         sleep(1)
-        psu.set_voltage("1", "2")
-        psu.set_voltage("2", "3")
-        psu.set_voltage("3", "4")
+        write_raw(STEP_2)
         sleep(1)
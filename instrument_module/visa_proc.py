@@ -0,0 +1,221 @@
+"""This module runs an instrument driver in a dedicated worker process,
+so blocking VISA I/O does not hold up the calling script (plotting,
+logging, other CPU work).
+
+The proxy classes expose the same methods as the drivers they wrap:
+    with DP800Proxy("IP", "10.0.142.1") as psu:
+        psu.set_voltage(chan=2, val=5.0)       # queued, returns at once
+        volt = psu.measure_voltage(chan=2)     # waits for the reply
+
+Setters are queued and return immediately. While the worker is busy, a
+newer call to the same setter for the same channel replaces the queued
+one, so the most recent value wins; other setters are never dropped.
+Queries (measurements, *IDN?, reset) block until the worker replies, and
+run after every setter queued before them.
+A proxy must only be used from one thread at a time.
+"""
+
+import inspect
+import multiprocessing
+import queue
+import threading
+from .rigol_dg4000 import DG4000
+from .rigol_dp800 import DP800
+
+POLL_INTERVAL = 0.5  # Seconds between checks that the worker is alive
+START_TIMEOUT = 30  # Seconds to wait for the worker to connect
+STOP_TIMEOUT = 5  # Seconds to wait for the worker to exit on close()
+_NOT_PROXIED = frozenset({"batch", "close"})  # Need the caller's process
+# Spawn rather than fork, so the worker opens its own resource manager and
+# session instead of inheriting the parent's VISA handles and cache lock
+_CTX = multiprocessing.get_context("spawn")
+
+
+def _portable(exc):
+    """Return exc if it can cross the process boundary as-is, otherwise a
+    RuntimeError carrying its description (e.g. for VisaIOError)."""
+    if type(exc).__module__ == "builtins":
+        return exc
+    return RuntimeError(f"{type(exc).__name__}: {exc}")
+
+
+def _worker(driver_cls, connection_method, address, cmd_q, reply_q):
+    """Own the driver and its VISA session, and execute queued calls.
+    Each message is (kind, method name, args, kwargs); kind "q" sends the
+    result back on reply_q. A None message closes the session and exits."""
+    try:
+        driver = driver_cls(connection_method, address)
+    except Exception as e:  # pylint: disable=broad-except
+        reply_q.put((False, _portable(e)))
+        return
+    reply_q.put((True, None))
+
+    while True:
+        msg = cmd_q.get()
+        if msg is None:
+            driver.close()
+            return
+        kind, name, args, kwargs = msg
+        try:
+            result = getattr(driver, name)(*args, **kwargs)
+        except Exception as e:  # pylint: disable=broad-except
+            if kind == "q":
+                reply_q.put((False, _portable(e)))
+            else:
+                print(f"{driver_cls.__name__}.{name} failed: {e}")
+            continue
+        if kind == "q":
+            reply_q.put((True, result))
+
+
+class _InstrumentProxy:
+    """Base class for driver proxies; subclasses set the driver class and
+    the names of its methods that return a value."""
+    _driver_cls = None
+    _queries = frozenset()
+
+    def __init__(self, connection_method, address):
+        self.address = address
+        # Holds at most one setter, so later ones coalesce in _pending
+        # while the worker is busy
+        self._cmd_q = _CTX.Queue(1)
+        self._reply_q = _CTX.Queue()
+        self._pending = {}  # Queued setter calls keyed by (name, chan)
+        self._cond = threading.Condition()  # Guards the fields below
+        self._sending = False  # A setter is being handed to the worker
+        self._closed = False
+        self._proc = _CTX.Process(
+            target=_worker,
+            args=(self._driver_cls, connection_method, address,
+                  self._cmd_q, self._reply_q),
+            daemon=True)
+        self._proc.start()
+        try:
+            ok, error = self._reply_q.get(timeout=START_TIMEOUT)
+        except queue.Empty:
+            self._proc.terminate()
+            raise ConnectionError(
+                f"Timed out connecting to {address}") from None
+        if not ok:
+            self._proc.join()
+            raise error
+        self._feeder = threading.Thread(target=self._feed, daemon=True)
+        self._feeder.start()
+
+    def __getattr__(self, name):
+        attr = getattr(self._driver_cls, name, None)
+        if name.startswith("_") or name in _NOT_PROXIED \
+                or not inspect.isfunction(attr) \
+                or inspect.iscoroutinefunction(attr):
+            raise AttributeError(
+                f"{type(self).__name__!r} object has no attribute {name!r}")
+        if name in self._queries:
+            return lambda *args, **kwargs: self._query(name, args, kwargs)
+        return lambda *args, **kwargs: self._write(name, args, kwargs)
+
+    def _worker_exited(self):
+        """Error raised when a call finds the worker process gone"""
+        return ConnectionError(
+            f"{self._driver_cls.__name__} worker for {self.address} exited")
+
+    def _write(self, name, args, kwargs):
+        """Queue a setter call, replacing a queued call to the same setter
+        for the same channel (the first argument)"""
+        chan = kwargs.get("chan", args[0] if args else None)
+        key = (name, None if chan is None else str(chan))
+        with self._cond:
+            self._pending.pop(key, None)
+            self._pending[key] = (name, args, kwargs)
+            self._cond.notify_all()
+
+    def _feed(self):
+        """Hand queued setters to the worker in order, one at a time"""
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                key = next(iter(self._pending))
+                name, args, kwargs = self._pending.pop(key)
+                self._sending = True
+            try:
+                self._put(("w", name, args, kwargs))
+            except ConnectionError as e:
+                print(f"{e}; dropping queued setters")
+                with self._cond:
+                    self._pending.clear()
+                    self._sending = False
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._sending = False
+                self._cond.notify_all()
+
+    def _put(self, msg):
+        """Put msg on the command queue, raising ConnectionError instead of
+        blocking forever if the worker has exited"""
+        while True:
+            try:
+                self._cmd_q.put(msg, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                if not self._proc.is_alive():
+                    raise self._worker_exited() from None
+
+    def _drain(self):
+        """Wait until every queued setter has been handed to the worker"""
+        with self._cond:
+            while self._pending or self._sending:
+                if not self._proc.is_alive():
+                    raise self._worker_exited()
+                self._cond.wait(POLL_INTERVAL)
+
+    def _query(self, name, args, kwargs):
+        """Queue a call after the pending setters and wait for its result"""
+        self._drain()
+        self._put(("q", name, args, kwargs))
+        while True:
+            try:
+                ok, result = self._reply_q.get(timeout=POLL_INTERVAL)
+                break
+            except queue.Empty:
+                if not self._proc.is_alive():
+                    raise self._worker_exited() from None
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        """Let the worker finish the queued calls, close the session and
+        exit"""
+        try:
+            self._drain()
+            self._put(None)
+        except ConnectionError:
+            pass
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._proc.join(STOP_TIMEOUT)
+        if self._proc.is_alive():
+            self._proc.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DG4000Proxy(_InstrumentProxy):
+    """DG4000 running in a worker process"""
+    _driver_cls = DG4000
+    _queries = frozenset({"get_idn", "factory_reset"})
+
+
+class DP800Proxy(_InstrumentProxy):
+    """DP800 running in a worker process"""
+    _driver_cls = DP800
+    _queries = frozenset({"measure_voltage", "measure_current",
+                          "measure_power", "measure_all", "factory_reset"})
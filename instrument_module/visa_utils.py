@@ -6,31 +6,119 @@ M. Capotosto
 NSLS-II Diagnostics and Instrumentation
 """
 
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 import pyvisa
-from pyvisa import VisaIOError
+from pyvisa import VisaIOError, constants
+from pyvisa.errors import InvalidSession
+
+_RM = None  # Shared resource manager, created on first use
+_CONN_CACHE = {}  # Open sessions keyed by resource string
+_CONN_LOCK = threading.Lock()  # Guards _CONN_CACHE
+SESSION_TIMEOUT = 1000  # Default VISA timeout in ms, fail fast on bad links
+SESSION_CHUNK_SIZE = 65536  # Read size for ordinary SCPI responses
+PROBE_TIMEOUT = 500  # *IDN? timeout in ms when scanning for instruments
 
 
 def get_resource_manager():
-    """Return a PyVISA resource manager instance."""
-    return pyvisa.ResourceManager()
+    """Return the shared PyVISA resource manager instance.
+
+    The VISA backend is initialized once per process and reused by every
+    instrument connection.
+    """
+    global _RM  # pylint: disable=global-statement
+    if _RM is None:
+        _RM = pyvisa.ResourceManager()
+    return _RM
+
+
+def _configure_session(device):
+    """Apply default session attributes right after open_resource, so
+    reads end at the LF terminator instead of waiting out a chunk or the
+    timeout. Drivers may override these afterwards."""
+    device.timeout = SESSION_TIMEOUT
+    device.query_delay = 0.0  # No pause between a query's write and read
+    device.read_termination = "\n"
+    device.write_termination = "\n"
+    device.chunk_size = SESSION_CHUNK_SIZE
+
+
+def _cached_session(resource_str):
+    """Return the cached session for resource_str, counting one more user,
+    or None if it is not open. A session closed directly with
+    device.close() is evicted so a fresh one gets opened."""
+    with _CONN_LOCK:
+        entry = _CONN_CACHE.get(resource_str)
+        if entry is None:
+            return None
+        try:
+            entry["device"].session  # pylint: disable=pointless-statement
+        except InvalidSession:
+            del _CONN_CACHE[resource_str]
+            return None
+        entry["refs"] += 1
+        return entry["device"]
+
+
+def _cache_session(resource_str, device):
+    """Add a newly opened session to the cache and return the session to
+    use. If another thread cached one for resource_str meanwhile, device
+    is closed and the cached one is returned instead."""
+    with _CONN_LOCK:
+        entry = _CONN_CACHE.get(resource_str)
+        if entry is None:
+            _CONN_CACHE[resource_str] = {
+                "device": device, "refs": 1,
+                "state": {"lock": threading.Lock()}}
+            return device
+        entry["refs"] += 1
+    device.close()
+    return entry["device"]
+
+
+def session_state(device):
+    """
+    Return the dict shared by every driver using the cached session
+    device. Its "lock" entry is a threading.Lock that serializes calls on
+    the session (see run_in_thread); drivers keep other per-session state,
+    such as the selected channel, in it too.
+    """
+    with _CONN_LOCK:
+        for entry in _CONN_CACHE.values():
+            if entry["device"] is device:
+                return entry["state"]
+    raise KeyError(f"{device!r} is not a cached session")
 
 
-def connect_usb_instrument(address):
+def connect_usb_instrument(address, rm=None):
     """
     connect USB instrument based on the
     given identifier.
+    rm (pyvisa.ResourceManager): Optional resource manager to open the
+        instrument with (default: the shared resource manager).
+    A session already opened for address is returned as-is, see
+    connect_ethernet_instrument.
     Returns (device, address, status) tuple.
     """
-    rm = get_resource_manager()
+    device = _cached_session(address)
+    if device is not None:
+        return device, address, "Connected"
+    rm = rm or get_resource_manager()
 
     try:
         device = rm.open_resource(address)
-        return device, address, "Connected"
     except VisaIOError:
         return None, None, "Not Connected"
 
+    _configure_session(device)
+    return _cache_session(address, device), address, "Connected"
+
 
-def connect_ethernet_instrument(ip_address, port=5025, use_socket=False):
+def connect_ethernet_instrument(ip_address, port=5025, use_socket=False,
+                                rm=None, protocol=None):
     """
     Connect to an Ethernet-based instrument using its IP address.
 
@@ -38,29 +126,167 @@ def connect_ethernet_instrument(ip_address, port=5025, use_socket=False):
         ip_address (str): The instrument's IP address.
         port (int): The port number (default: 5025 for SCPI over raw socket).
         use_socket (bool): Whether to use raw socket communication.
+            Shorthand for protocol="socket".
+        rm (pyvisa.ResourceManager): Optional resource manager to open the
+            instrument with (default: the shared resource manager).
+        protocol (str): "hislip", "vxi11" or "socket" (default: "hislip",
+            or "socket" if use_socket is set).
 
-        VXI-11 (TCPIP0::<IP>::INSTR) --> use_socket=False
-        HiSLIP (TCPIP0::<IP>::hislip0) --> use_socket=False
-        Raw Socket (TCPIP0::<IP>::5025::SOCKET) --> use_socket=True
+        HiSLIP (TCPIP0::<IP>::hislip0::INSTR) --> protocol="hislip"
+            Falls back to VXI-11 if the instrument has no HiSLIP server.
+        VXI-11 (TCPIP0::<IP>::INSTR) --> protocol="vxi11"
+        Raw Socket (TCPIP0::<IP>::5025::SOCKET) --> protocol="socket"
+
+    A session already opened for the resource string is returned as-is,
+    so re-creating a driver for the same instrument skips the VXI-11 /
+    HiSLIP session setup. It stays open until close_instrument() has been
+    called once for every connect that returned it.
 
     Returns:
         device (pyvisa.Resource): The VISA instrument resource.
         address (str): The VISA resource string used.
         status (str): Connection status.
     """
-    rm = get_resource_manager()
+    rm = rm or get_resource_manager()
 
-    if use_socket:
-        resource_str = f"TCPIP0::{ip_address}::{port}::SOCKET"
+    if protocol is None:
+        protocol = "socket" if use_socket else "hislip"
+    if protocol == "hislip":
+        resource_strs = [f"TCPIP0::{ip_address}::hislip0::INSTR",
+                         f"TCPIP0::{ip_address}::INSTR"]
+    elif protocol == "vxi11":
+        resource_strs = [f"TCPIP0::{ip_address}::INSTR"]
+    elif protocol == "socket":
+        resource_strs = [f"TCPIP0::{ip_address}::{port}::SOCKET"]
     else:
-        resource_str = f"TCPIP0::{ip_address}::INSTR"  # VISA over Ethernet
+        raise ValueError(f"Unknown protocol {protocol!r}")
 
-    try:
-        device = rm.open_resource(resource_str)
-        return device, resource_str, "Connected"
-    except VisaIOError:
+    for resource_str in resource_strs:
+        device = _cached_session(resource_str)
+        if device is not None:
+            return device, resource_str, "Connected"
+    for resource_str in resource_strs:
+        try:
+            device = rm.open_resource(resource_str)
+            break
+        except VisaIOError:
+            continue
+    else:
         return None, None, "Not Connected"
 
+    _configure_session(device)
+    if "::hislip" in resource_str:
+        device.chunk_size = 1 << 20
+    elif protocol == "socket":
+        device.send_end = True
+        # Disable Nagle's algorithm so short SCPI writes go out at once
+        # instead of waiting up to 200ms to be coalesced.
+        try:
+            device.set_visa_attribute(constants.VI_ATTR_TCPIP_NODELAY,
+                                      constants.VI_TRUE)
+        except VisaIOError as e:
+            print(f"Could not enable TCP_NODELAY on {resource_str}: {e}")
+    return _cache_session(resource_str, device), resource_str, "Connected"
+
+
+def close_instrument(device):
+    """
+    Release a session returned by connect_usb_instrument or
+    connect_ethernet_instrument. The session is only closed and evicted
+    from the connection cache once every connect that returned it has
+    been released, so other drivers sharing it keep working.
+    """
+    if device is None:
+        return
+    with _CONN_LOCK:
+        for resource_str, entry in list(_CONN_CACHE.items()):
+            if entry["device"] is device:
+                entry["refs"] -= 1
+                if entry["refs"] > 0:
+                    return
+                del _CONN_CACHE[resource_str]
+    device.close()
+
+
+def write_sync(device, command):
+    """
+    Send a command and block until the instrument has finished executing
+    it, by appending *OPC? and waiting for the reply. Use instead of a
+    fixed sleep when a later command depends on this one completing.
+    """
+    return device.query(f"{command};*OPC?")
+
+
+@contextmanager
+def temporary_timeout(device, timeout):
+    """Set device.timeout (ms) for the duration of a with block, e.g. for
+    a query that is known to take longer than usual."""
+    old_timeout = device.timeout
+    device.timeout = timeout
+    try:
+        yield device
+    finally:
+        device.timeout = old_timeout
+
+
+def parallel(*calls):
+    """
+    Run independent blocking instrument calls concurrently.
+
+    Each call is a zero-argument callable (e.g. a lambda or
+    functools.partial). Calls run in a thread pool, so operations on
+    different instruments overlap their VISA I/O instead of waiting on
+    each other. Calls on the same instrument should not be mixed, since a
+    session is not safe to use from several threads at once.
+
+    Example:
+        parallel(lambda: src.current("1e-3", sync=True),
+                 lambda: psu.set_voltage(chan=1, val=5.0))
+        vout, = parallel(dmm.meas_dcv)
+
+    Returns:
+        list: The return value of each call, in argument order. The first
+        exception raised by a call is re-raised.
+    """
+    if not calls:
+        return []
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [executor.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+
+async def run_in_thread(lock, func, *args, **kwargs):
+    """
+    Await a blocking driver call without blocking the event loop.
+
+    The call runs in the loop's default thread pool while holding lock,
+    a threading.Lock owned by the instrument, so calls that share one VISA
+    session run one at a time while calls on different instruments
+    overlap (e.g. with asyncio.gather).
+    """
+    def locked_call():
+        with lock:
+            return func(*args, **kwargs)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, locked_call)
+
+
+def _probe(rm, inst):
+    """Query *IDN? from one resource.
+    Returns (resource, IDN response or the VisaIOError raised)."""
+    try:
+        # Open the instrument resource, closing it again after the
+        # probe so repeated scans do not leak sessions
+        with rm.open_resource(inst) as device:
+            # A short timeout keeps a dead instrument from holding up
+            # the scan
+            device.timeout = PROBE_TIMEOUT
+            # Send the *IDN? query and get the response
+            return inst, device.query("*IDN?").strip()
+    except pyvisa.VisaIOError as e:
+        return inst, e
+
 
 def list_instruments():
     """List all available instruments on the network."""
@@ -68,14 +294,17 @@ def list_instruments():
     instruments = rm.list_resources()
 
     if instruments:
+        # Probe all resources at once; each probe mostly waits on I/O
+        with ThreadPoolExecutor(max_workers=min(16, len(instruments))) \
+                as executor:
+            results = list(executor.map(partial(_probe, rm), instruments))
+
         print("Available Instruments:")
-        for inst in instruments:
+        for inst, idn_response in results:
             print(f" - {inst}")
-            try:
-                # Open the instrument resource
-                device = rm.open_resource(inst)
-                # Send the *IDN? query and get the response
-                idn_response = device.query("*IDN?").strip()
+            if isinstance(idn_response, pyvisa.VisaIOError):
+                print(f"   Error communicating with {inst}: {idn_response}")
+            else:
                 # Split the response by commas and display with titles
                 idn_parts = idn_response.split(",")
                 if len(idn_parts) == 4:
@@ -85,8 +314,6 @@ def list_instruments():
                     print(f"   Firmware Version: {idn_parts[3]}")
                 else:
                     print("   Unrecognized IDN format.")
-            except pyvisa.VisaIOError as e:
-                print(f"   Error communicating with {inst}: {e}")
     else:
         print("No instruments found.")
 
@@ -0,0 +1,65 @@
+"""Fake VISA resources, so the drivers can be tested without hardware or
+a VISA library."""
+
+import pytest
+from pyvisa import VisaIOError, constants
+from pyvisa.errors import InvalidSession
+from instrument_module import visa_utils
+
+
+class FakeResource:
+    """Records every message written; queries answer "1"."""
+    def __init__(self, resource_str, log):
+        self.resource_str = resource_str
+        self.log = log
+        self.timeout = None
+        self.closed = False
+        self.fail_next = False  # Raise on the next write or query
+
+    @property
+    def session(self):
+        """Raise InvalidSession once closed, like pyvisa.Resource"""
+        if self.closed:
+            raise InvalidSession()
+        return 1
+
+    def _send(self, message):
+        if self.fail_next:
+            self.fail_next = False
+            raise VisaIOError(constants.StatusCode.error_timeout)
+        self.log.append(message)
+
+    def write(self, message):
+        self._send(message)
+
+    def query(self, message):
+        self._send(message)
+        return "1"
+
+    def set_visa_attribute(self, *_):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeResourceManager:
+    """Opens FakeResources that share one message log"""
+    def __init__(self):
+        self.log = []
+        self.opened = []
+
+    def open_resource(self, resource_str):
+        device = FakeResource(resource_str, self.log)
+        self.opened.append(device)
+        return device
+
+
+@pytest.fixture
+def fake_rm(monkeypatch):
+    """Route connect_* through a FakeResourceManager with an empty
+    connection cache"""
+    rm = FakeResourceManager()
+    monkeypatch.setattr(visa_utils, "get_resource_manager", lambda: rm)
+    monkeypatch.setattr(visa_utils, "_CONN_CACHE", {})
+    return rm
@@ -0,0 +1,84 @@
+"""Tests for the DP800 channel selection tracking"""
+
+import pytest
+from pyvisa import VisaIOError
+from instrument_module.rigol_dp800 import DP800
+
+
+@pytest.fixture
+def psu(fake_rm):  # pylint: disable=unused-argument
+    """DP800 on a fake session"""
+    with DP800("IP", "10.0.142.1") as psu:
+        yield psu
+
+
+def test_select_only_on_channel_change(psu, fake_rm):
+    psu.set_voltage(1, 5)
+    psu.set_current(1, 0.5)
+    psu.set_voltage(2, 3)
+    assert fake_rm.log == [":INST:NSEL 1;:VOLT 5;*OPC?",
+                           ":CURR 0.5;*OPC?",
+                           ":INST:NSEL 2;:VOLT 3;*OPC?"]
+
+
+def test_selection_shared_between_drivers(psu, fake_rm):
+    with DP800("IP", "10.0.142.1") as other:
+        psu.set_voltage(1, 5)
+        other.set_voltage(2, 3)
+        psu.set_voltage(1, 6)
+    assert fake_rm.log[-1] == ":INST:NSEL 1;:VOLT 6;*OPC?"
+
+
+def test_failed_write_forces_select(psu, fake_rm):
+    psu.set_voltage(1, 5)
+    psu.device.fail_next = True
+    with pytest.raises(VisaIOError):
+        psu.set_voltage(1, 6)
+    psu.set_voltage(1, 7)
+    assert fake_rm.log[-1] == ":INST:NSEL 1;:VOLT 7;*OPC?"
+
+
+def test_batch_sends_one_message(psu, fake_rm):
+    psu.set_voltage(1, 5)
+    with psu.batch():
+        psu.set_voltage(1, 6)
+        with psu.batch():  # Joins the outer block
+            psu.set_voltage(2, 3)
+            psu.toggle_output(2, "ON")
+        assert not fake_rm.log[1:]
+    assert fake_rm.log[1:] == [
+        ":INST:NSEL 1;:VOLT 6;:INST:NSEL 2;:VOLT 3;:OUTP CH2,ON;*OPC?"]
+    psu.set_current(2, 0.5)
+    assert fake_rm.log[-1] == ":CURR 0.5;*OPC?"
+
+
+def test_batch_selection_stays_local(psu, fake_rm):
+    with DP800("IP", "10.0.142.1") as other:
+        with psu.batch():
+            psu.set_voltage(1, 5)
+            other.set_voltage(2, 3)  # Not buffered; selects channel 2
+            psu.set_voltage(1, 6)
+        other.set_voltage(2, 4)
+    assert fake_rm.log == [":INST:NSEL 2;:VOLT 3;*OPC?",
+                           ":INST:NSEL 1;:VOLT 5;:VOLT 6;*OPC?",
+                           ":INST:NSEL 2;:VOLT 4;*OPC?"]
+
+
+def test_batch_discarded_on_error(psu, fake_rm):
+    psu.set_voltage(1, 5)
+    with pytest.raises(RuntimeError):
+        with psu.batch():
+            psu.set_voltage(2, 3)
+            raise RuntimeError
+    psu.set_voltage(1, 6)
+    assert fake_rm.log == [":INST:NSEL 1;:VOLT 5;*OPC?", ":VOLT 6;*OPC?"]
+
+
+def test_failed_flush_forces_select(psu, fake_rm):
+    psu.set_voltage(1, 5)
+    psu.device.fail_next = True
+    with pytest.raises(VisaIOError):
+        with psu.batch():
+            psu.set_voltage(2, 3)
+    psu.set_voltage(2, 4)
+    assert fake_rm.log[-1] == ":INST:NSEL 2;:VOLT 4;*OPC?"
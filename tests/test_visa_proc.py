@@ -0,0 +1,86 @@
+"""Tests for the worker process proxies, using a fake driver so no VISA
+session is needed. The worker is spawned, so the fake driver must stay
+importable at module level."""
+
+import os
+import time
+import pytest
+from instrument_module.visa_proc import _InstrumentProxy
+
+
+class FakeDriver:
+    """Records the setter calls it receives"""
+    def __init__(self, connection_method, address):
+        if address == "unreachable":
+            raise ConnectionError(f"Could not connect to {address} over "
+                                  f"{connection_method}")
+        self.calls = []
+
+    def close(self):
+        pass
+
+    def busy(self, seconds):
+        """Keep the worker busy so later setters queue up"""
+        time.sleep(seconds)
+
+    def set_voltage(self, chan, val):
+        self.calls.append(("set_voltage", chan, val))
+
+    def set_ovp(self, chan, val):
+        self.calls.append(("set_ovp", chan, val))
+
+    def crash(self):
+        os._exit(1)  # pylint: disable=protected-access
+
+    def get_calls(self):
+        return self.calls
+
+
+class FakeProxy(_InstrumentProxy):
+    """FakeDriver running in a worker process"""
+    _driver_cls = FakeDriver
+    _queries = frozenset({"get_calls"})
+
+
+def test_setters_run_before_query():
+    with FakeProxy("IP", "10.0.0.1") as proxy:
+        proxy.set_voltage(1, 5.0)
+        proxy.set_ovp(chan=2, val=6.0)
+        assert proxy.get_calls() == [("set_voltage", 1, 5.0),
+                                     ("set_ovp", 2, 6.0)]
+
+
+def test_queued_setters_coalesce():
+    with FakeProxy("IP", "10.0.0.1") as proxy:
+        proxy.busy(1)
+        proxy.set_voltage(1, 1.0)
+        time.sleep(0.1)  # Handed to the command queue
+        proxy.set_ovp(1, 9.0)
+        time.sleep(0.1)  # Held by the feeder until the queue has room
+        proxy.set_voltage(1, 2.0)
+        proxy.set_voltage("1", 3.0)  # Same channel, latest value wins
+        assert proxy.get_calls() == [("set_voltage", 1, 1.0),
+                                     ("set_ovp", 1, 9.0),
+                                     ("set_voltage", "1", 3.0)]
+
+
+def test_private_and_batch_not_proxied():
+    with FakeProxy("IP", "10.0.0.1") as proxy:
+        with pytest.raises(AttributeError):
+            proxy.batch  # pylint: disable=pointless-statement
+        with pytest.raises(AttributeError):
+            proxy.calls  # pylint: disable=pointless-statement
+
+
+def test_connect_error_is_raised():
+    with pytest.raises(ConnectionError):
+        FakeProxy("IP", "unreachable")
+
+
+def test_dead_worker_raises():
+    proxy = FakeProxy("IP", "10.0.0.1")
+    proxy.crash()
+    with pytest.raises(ConnectionError, match="exited"):
+        proxy.get_calls()
+    proxy.close()  # Must not hang
+    assert not proxy._proc.is_alive()  # pylint: disable=protected-access
@@ -0,0 +1,44 @@
+"""Tests for the refcounted session cache in visa_utils"""
+
+from instrument_module import visa_utils
+from instrument_module.visa_utils import connect_ethernet_instrument, \
+    connect_usb_instrument, close_instrument, session_state
+
+USB_ADDRESS = "USB0::0x1AB1::0x0E11::DP8A0001::INSTR"
+
+
+def test_reconnect_reuses_session(fake_rm):
+    dev_a, addr_a, status_a = connect_ethernet_instrument("10.0.0.1")
+    dev_b, addr_b, _ = connect_ethernet_instrument("10.0.0.1")
+    assert status_a == "Connected"
+    assert dev_a is dev_b and addr_a == addr_b
+    assert len(fake_rm.opened) == 1
+    assert session_state(dev_a) is session_state(dev_b)
+
+
+def test_session_closed_after_last_release(fake_rm):
+    device, _, _ = connect_usb_instrument(USB_ADDRESS)
+    connect_usb_instrument(USB_ADDRESS)
+    close_instrument(device)
+    assert not device.closed  # Still used by the second connect
+    close_instrument(device)
+    assert device.closed
+    assert not visa_utils._CONN_CACHE  # pylint: disable=protected-access
+
+    reopened, _, _ = connect_usb_instrument(USB_ADDRESS)
+    assert reopened is not device
+    assert len(fake_rm.opened) == 2
+
+
+def test_directly_closed_session_is_evicted(fake_rm):
+    device, _, _ = connect_usb_instrument(USB_ADDRESS)
+    device.close()
+    reopened, _, status = connect_usb_instrument(USB_ADDRESS)
+    assert status == "Connected"
+    assert reopened is not device and not reopened.closed
+    assert len(fake_rm.opened) == 2
+
+
+def test_close_instrument_ignores_none(fake_rm):
+    close_instrument(None)
+    assert not fake_rm.opened